@@ -2,18 +2,15 @@
 
 import numpy as np
 import os
-from glob import glob
 import itertools
+import fnmatch
+from collections import defaultdict
 import argparse
 import sys
-import scipy.ndimage as ndi
 import cv2
 import tifffile as tf 
-import tkinter as tk
-from tkinter import messagebox
-from tkinter.filedialog import askopenfilename
-from tkinter.filedialog import askdirectory
 import re
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # Script Info
 __author__  = 'Nick Chahley, https://github.com/nickchahley'
@@ -21,43 +18,79 @@ __url__     = 'https://github.com/junckerlab/channel_merge'
 __version__ = '1.1'
 __date__     = '2019-08-05'
 
+# scipy.ndimage boundary modes -> equivalent OpenCV border types
+BORDER_MODES = {'nearest'  : cv2.BORDER_REPLICATE,
+                'reflect'  : cv2.BORDER_REFLECT,
+                'mirror'   : cv2.BORDER_REFLECT_101,
+                'constant' : cv2.BORDER_CONSTANT}
+# scipy.ndimage boundary modes -> equivalent np.pad modes
+PAD_MODES = {'nearest'  : 'edge',
+             'reflect'  : 'symmetric',
+             'mirror'   : 'reflect',
+             'constant' : 'constant'}
+
+# <id digits><channel name>[-<alt scan num>].<ext>, '-' separators optional.
+# The channel name must start with a non-digit, so '01-2.tif' doesn't match
+FILENAME_RE = re.compile(
+    r'^(?P<pfx>\d+)(?P<mid>-?[^\d-].*?)(?:-?(?P<trail>\d+))?\.(?P<ext>[^.]+)$')
+
+# The illumination estimate is computed on an im shrunk by up to this factor,
+# keeping at least MIN_DOWNSAMPLED_SIGMA px of blur at the reduced size
+MAX_DOWNSAMPLE = 8
+MIN_DOWNSAMPLED_SIGMA = 6.
+
+# Above this sigma the blur is done in the frequency domain, where the cost no
+# longer scales with kernel size. This is the sigma after downsampling, so with
+# MAX_DOWNSAMPLE = 8 only a requested sigma of 160 or more gets there; the
+# default sigma blurs at ~6 px with cv2 and never touches the fft
+FFT_SIGMA = 20.
+# Cache of gaussian transfer functions, keyed on (padded shape, sigma)
+_fft_kernels = {}
+# fft interface the fft blur uses and the threads it may use, see fft_module
+_fft = None
+_fft_threads = os.cpu_count()
+
 
 def main(args):
     """ args: argparse arguments
     """
     if args.path:
         path = args.path
-        rootpath = os.getcwd()
     else:
         path = path_dialog(whatyouwant = 'folder')
-    os.chdir(path)
 
-    # Filename String Manipulations
+    # Filename String Manipulations. Filenames are handled as basenames in
+    # path, rather than chdir'ing into it, so that several dirs can be
+    # processed at once in one process
     print('Formatting filenames...')
-    filenames = cleanup_filenames(glob('*.tif'))
+    # fnmatch, like glob, matches case insensitively on Windows
+    filenames = [f for f in fnmatch.filter(os.listdir(path), '*.tif')
+                 if not f.startswith('.')]
+    filenames = cleanup_filenames(filenames, path)
     channels = group_images(filenames)
-    imgs = tiffs_iterate_combos(channels)
+    imgs = tiffs_iterate_combos(channels, path)
 
     # Image Processing
     print('Processing images...')
-    rgb = preproc_imgs(imgs, sigma = args.sigma)
+    # sigma is fixed for the run, build the blur kernel once up front
+    kernel = blur_kernel(args.sigma)
+    rgb = preproc_imgs(imgs, sigma = args.sigma, kernel = kernel)
     rgb = outfile_names(rgb)
 
     # Make output dir if it does not exist
+    outdir = os.path.join(path, args.outdir)
     print('Writing images to %s' % args.outdir)
-    if not os.path.exists(args.outdir):
-        os.makedirs(args.outdir)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
     
-    # Write the rgb stacks to files in output dir
-    for fname, im in rgb.items():
-        tiffwrite('/'.join((args.outdir, fname)), im)
+    # Write the rgb stacks to files in output dir. Compression is CPU bound and
+    # releases the GIL, so write files in parallel
+    outfiles = [os.path.join(outdir, fname) for fname in rgb]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        list(ex.map(tiffwrite, outfiles, rgb.values()))
 
     # Cleanup any tmp files
-    cleanup()
-
-    if args.path:
-        # go back to root as to not mess up next script exec
-        os.chdir(rootpath)
+    cleanup(path)
 
     # FREEDOM
 
@@ -89,6 +122,10 @@ def parse_args():
     return args
 
 def popup_message(text = '', title='Message'):
+    # tkinter is only imported when a dialog is actually shown, so --path
+    # batch runs never load it
+    import tkinter as tk
+    from tkinter import messagebox
     root = tk.Tk().withdraw()  # hide the root window
     messagebox.showinfo(title, text)  # show the messagebo
 
@@ -105,6 +142,10 @@ def path_dialog(whatyouwant):
     path : str, Absolute path to file
 
     """
+    import tkinter as tk
+    from tkinter.filedialog import askopenfilename
+    from tkinter.filedialog import askdirectory
+
     # TODO allow multiple (shift-click) dir selections
     root = tk.Tk()
     root.withdraw()
@@ -134,10 +175,12 @@ def path_dialog(whatyouwant):
 
     return path
 
-def cleanup_filenames(filenames):
-    """ replace whitespace and exclude bright field tiff files """
+def cleanup_filenames(filenames, path='.'):
+    """ replace whitespace and separate trailing digits in filenames, renaming
+    the files in dir path on disk """
 
     def safe_rename(old, new):
+        old, new = os.path.join(path, old), os.path.join(path, new)
         if os.path.exists(new):
             # Skip to avoid clobbering new. If this breaks the script it will
             # be caught 
@@ -148,36 +191,16 @@ def cleanup_filenames(filenames):
     def format_filenames(filenames):
 
         def format_trailing_nums(s):
-
-            # trim .extension
-            sp = '.'.join(s.split('.')[:-1])
-
-            # match digits at end of string
-            m = re.search('\d+$', sp)
+            # string does not look like <digits><channel>[num].ext, leave it
+            m = FILENAME_RE.match(s)
             if not m:
-                # string does not end in num, ex. '01-blue.tif'
-                new = s
-            else:
-                # string ends in num, ex. '01-blue-2.tif'
-                endnum = m.group()
-                new = endnum.join(sp.split(endnum)[:-1])
-                if new[-1] == '-':
-                    # Trailing '-', rm to avoid getting '01-blue--2.tif'
-                    new = new[:-1]
-                ext = '.' + s.split('.')[-1]
-                new = '-'.join((new, endnum)) + ext
-
-            # correct no seperator following prefix digits
-            # if I was good at regex this would take like zero lines
-            pfx = new.split('-')[0]
-            if not pfx.isdigit():
-                m = re.search('^\d+', pfx)
-                if m:
-                    mid = pfx.replace(m.group(), '')
-                    end = '-'.join(new.split('-')[1:])
-                    new = '-'.join((m.group(), mid, end))
-
-            return new
+                return s
+            # ensure a '-' after the prefix digits and before trailing digits
+            new = '-'.join((m.group('pfx'), m.group('mid').lstrip('-')))
+            if m.group('trail'):
+                new = '-'.join((new, m.group('trail')))
+            return '.'.join((new, m.group('ext')))
+
         # replace whitespace
         filenames = ['-'.join(f.split()) for f in filenames]
 
@@ -188,18 +211,16 @@ def cleanup_filenames(filenames):
     # Rename the files to be compliant with the format <id>-channel[-num].tif
     fmt_filenames = format_filenames(filenames)
     for old, new in zip(filenames, fmt_filenames):
-        safe_rename(old, new)
-
+        # most names are already compliant, don't touch the fs for those
+        if old != new:
+            safe_rename(old, new)
 
-    # Exclude brightfield files from downstream processing
-    fmt_filenames = [f for f in fmt_filenames if '-bf' not in f]
-    fmt_filenames.sort()
     return fmt_filenames
 
 def group_images(filenames):
     """ 
     Return a dict containing image numbers as keys and a list of their
-    associated filenames as values. 
+    associated filenames as values. Bright field tiffs are excluded.
     
     2018-08-28
     Should now not include files like 101-red.tif in group 01.
@@ -211,20 +232,18 @@ def group_images(filenames):
         <dd>-<color[text]>.tif : for 1st scans "norm"
         <dd>-<color[text]>-<d>.tif : for 2nd+ scans "extra"
     """
-    nums = [f.split('-')[0] for f in filenames]
-    nums = sorted(set(nums)) # rm repeats and back to sorted list
-    
-
-    # Make dict of img num and channel files
-    channels = [] 
-    for n in nums:
-        channels.append([f for f in filenames if n == f.split('-')[0]])
-    channels.sort()
-    channels = dict(zip(nums, channels))
+    # Make dict of img num and channel files in one pass, excluding
+    # brightfield files from downstream processing
+    groups = defaultdict(list)
+    for f in sorted(filenames):
+        if '-bf' in f:
+            continue
+        groups[f.split('-', 1)[0]].append(f)
+    channels = dict(sorted(groups.items()))
 
     return channels
 
-def tiffs_iterate_combos(channels):
+def tiffs_iterate_combos(channels, path='.'):
     """ Ret dict with key for each image number make all possible rgb
     combinations. 
 
@@ -237,10 +256,13 @@ def tiffs_iterate_combos(channels):
     ^ no that's wrong. I'm actually feeding it:
         { <id> : [<filenames>] }
 
+    path : dir containing the files in channels
+
     Out
     ---
     imgs : dict of lists of tuples. Each tuple is one rgb combination. Each 
-        list is all tuples for a given image number.
+        list is all tuples for a given image number. Filenames are joined to
+        path.
     """
     def allow_two_channels(im_id, colors):
         """ If there are exactly two channels, fill the empty channel with a
@@ -261,9 +283,9 @@ def tiffs_iterate_combos(channels):
             dtype as model_tif (the name of an actual tif file to open and read
             from).
             """
-            model = tiffread(model_tif)
+            model = tiffread(os.path.join(path, model_tif))
             dummy = np.zeros_like(model)
-            tiffwrite(dummy_name, dummy)
+            tiffwrite(os.path.join(path, dummy_name), dummy)
         if is_two_channels(colors):
             # model_tif will get overwritten, fine, just need one im to sample
             # shape of dummy from
@@ -275,7 +297,7 @@ def tiffs_iterate_combos(channels):
                     filenames.append(dummy_name)
                 elif len(filenames) == 1:
                     # grab the only filename
-                    model_tif = filenames
+                    model_tif = filenames[0]
                 else:
                     # grab the first filename
                     model_tif = filenames[0]
@@ -297,23 +319,18 @@ def tiffs_iterate_combos(channels):
             try:
                 # get the first letter of word following the img num prefix ('\d*-')
                 c = f.split('-')[1].lower()[0]
-                if c is 'r':
-                    colors['r'].append(f)
-                elif c is 'g':
-                    colors['g'].append(f)
-                elif c is 'b':
-                    colors['b'].append(f)
+                if c in colors:
+                    colors[c].append(f)
             except IndexError as e:
                 bad_files.append(f)
 
         # if exactly two channels exist add a dummy plug for the third
         colors = allow_two_channels(im_id, colors)
 
-        # choose one item from each list, making all possible combos
-        combos = [p for p in itertools.product(*colors.values())]
-
-        # reverse alpha sort each tuple so that order is rgb 
-        combos = [sorted(t, reverse=True) for t in combos]
+        # choose one item from each list, making all possible combos. Drawing
+        # from the lists in r, g, b order means each combo is already rgb
+        combos = [[os.path.join(path, f) for f in p] for p in
+                  itertools.product(colors['r'], colors['g'], colors['b'])]
 
         imgs[im_id] = combos 
 
@@ -337,11 +354,12 @@ def tiffs_iterate_combos(channels):
     # dict( list( tuple ) )
     return imgs
 
-def preproc_imgs(imgs, sigma, mode='nearest'):
+def preproc_imgs(imgs, sigma, mode='nearest', kernel=None):
     """ 
     Hastily commented preprocessing. 'uids' is a dumb name for this dict.
 
     imgs : dict w/ image numbers as keys 
+    kernel : blur_kernel(sigma), built here if not given
     """
     def get_uids(imgs):
         # Get a unique id for each distinct len3 list of r,g,b files
@@ -364,49 +382,284 @@ def preproc_imgs(imgs, sigma, mode='nearest'):
         return uids
     def fill_missing_channels(imls):
         return
-    def illum_correction(x, sigma, mode='nearest', method='subtract'):
-        """ 
-        Gaussian blurr background subtraction.
 
-        Aim is to smooth image until it is devoid of features, but retains the
-        weighted average intensity across the image that corresponds to the
-        underlying illumination pattern. Then subtract
+    uids = get_uids(imgs)
+    if kernel is None:
+        kernel = blur_kernel(sigma)
 
-        This correction is only aware of the single image/channel that it is fed.
-        It might be a better idea to try and implement illumination correction
-        using multiple channels/images taken from the same experiment.
-        """
-        y = ndi.gaussian_filter(x, sigma=sigma, mode=mode, cval=0)
-        if method == 'subtract':
-            return cv2.subtract(x, y)
-        elif method == 'divide':
-            return cv2.divide(x, y)
-        else:
-            raise ValueError("Unsupported method: %s" %method)
+    # Group the rgb combos by image number. Combos of the same image share
+    # channel files, which are then only read and corrected once
+    groups = defaultdict(dict)
+    for uid, imls in uids.items():
+        groups[uid.split('-')[0]][uid] = imls
 
-    uids = get_uids(imgs)
     # For each set of 3 channel filenames, read each image, preform
     # illumination correction, and stack them together into an rgb image.
+    # Large batches are spread over processes so that reading one image
+    # overlaps with correcting another.
+    n_workers = os.cpu_count() or 1
+    jobs = (groups.values(), itertools.repeat(sigma), itertools.repeat(mode),
+            itertools.repeat(kernel))
+    if len(groups) > n_workers:
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 initializer=_init_worker) as ex:
+            merged = list(ex.map(merge_channels, *jobs))
+    else:
+        # Read the next image's channels in the background while the current
+        # one is being corrected
+        prefetch = prefetched(read_channels, groups.values())
+        merged = list(map(merge_channels, *jobs, prefetch))
+
     rgb = {}
-    for uid, imls in uids.items():
+    for group in merged:
+        rgb.update(group)
+    return rgb
 
-        # List of greyscale channel ims : r,g,b
-        ims = [tiffread(f) for f in imls]
+def _init_worker():
+    """ Runs in each ProcessPoolExecutor worker. There's already one worker per
+    core, so keep cv2 and fftw single threaded rather than have every worker
+    start a thread per core on top of that.
+    """
+    global _fft, _fft_threads
+    cv2.setNumThreads(1)
+    # fft_module (re)configures fftw on its next call in this worker
+    _fft_threads = 1
+    _fft = None
 
-        # Guassian blur bg subtraction for each channel
-        ims_corr = [illum_correction(x, sigma, mode) for x in ims]
+def merge_channels(combos, sigma, mode='nearest', kernel=None, ims=None):
+    """ For each uid : [r, g, b filenames] in combos, read the channel files,
+    illumination correct each and stack them into one rgb image. Returns a
+    dict of uid : rgb im, leaving out combos whose channels can't be stacked.
 
-        try:
-            rgb[uid] = np.dstack(ims_corr)
-        except ValueError as e:
-            print('Skipping image # %s. Channels have non uniform shape? %s' 
-                  % (uid, e))
-            print('R: %s' % str(ims_corr[0].shape))
-            print('G: %s' % str(ims_corr[1].shape))
-            print('B: %s' % str(ims_corr[2].shape))
-    
+    Each distinct channel file in combos is only read and corrected once, no
+    matter how many combos it's part of.
+
+    ims : read_channels(combos) if it's already been read
+
+    Module level (rather than inside preproc_imgs) so it can be pickled off to
+    worker processes.
+    """
+    # Dict of filename : greyscale channel im
+    if ims is None:
+        ims = read_channels(combos)
+
+    # Only 2D greyscale channels can be corrected and stacked, leave out any
+    # combo with a channel file that isn't (e.g. saved as rgb, or a stack)
+    bad = {f for f, x in ims.items() if x.ndim != 2}
+    for uid, imls in combos.items():
+        if bad.intersection(imls):
+            print('Skipping image # %s. Channels are not 2D greyscale?' % uid)
+            print('R: %s' % str(ims[imls[0]].shape))
+            print('G: %s' % str(ims[imls[1]].shape))
+            print('B: %s' % str(ims[imls[2]].shape))
+    combos = {uid: imls for uid, imls in combos.items()
+              if not bad.intersection(imls)}
+    ims = {f: ims[f] for imls in combos.values() for f in imls}
+    if not ims:
+        return {}
+
+    # Guassian blur bg subtraction for each channel file. Files are independent
+    # and cv2/numpy release the GIL, so correct them in parallel threads. Each
+    # is corrected into its own contiguous buffer and only interleaved into
+    # rgb afterwards, so the threads never write to the same cache lines
+    def correct(f):
+        return illum_correction(ims[f], sigma, mode, kernel=kernel)
+    with ThreadPoolExecutor(max_workers=len(ims)) as ex:
+        corrected = dict(zip(ims, ex.map(correct, ims)))
+
+    rgb = {}
+    for uid, imls in combos.items():
+        planes = [corrected[f] for f in imls]
+        if len(set(x.shape for x in planes)) > 1:
+            print('Skipping image # %s. Channels have non uniform shape?' % uid)
+            print('R: %s' % str(planes[0].shape))
+            print('G: %s' % str(planes[1].shape))
+            print('B: %s' % str(planes[2].shape))
+            continue
+        # Preallocate the rgb stack and write each corrected plane straight
+        # into its slot, casting to the common dtype on the way in
+        out = np.empty(planes[0].shape + (3,), np.result_type(*planes))
+        for i, x in enumerate(planes):
+            out[..., i] = x
+        rgb[uid] = out
     return rgb
 
+def read_channels(combos):
+    """ Read each distinct channel file in combos (uid : [filenames]), in their
+    working dtype. Returns a dict of filename : im. Files are read in parallel
+    threads since tiff decoding releases the GIL.
+    """
+    def read(f):
+        x = tiffread(f)
+        # tiffread only maps uncompressed tiffs, load the data here so the disk
+        # reads happen in this thread instead of on first touch in the blur
+        if isinstance(x, np.memmap):
+            x = np.array(x)
+        return as_working_dtype(x)
+
+    files = list(dict.fromkeys(f for imls in combos.values() for f in imls))
+    with ThreadPoolExecutor(max_workers=len(files)) as ex:
+        return dict(zip(files, ex.map(read, files)))
+
+def prefetched(func, items):
+    """ Generate func(item) for each of items, computing the next result in a
+    background thread while the caller works on the current one.
+    """
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        future = None
+        for item in items:
+            next_future = ex.submit(func, item)
+            if future is not None:
+                yield future.result()
+            future = next_future
+        if future is not None:
+            yield future.result()
+
+def as_working_dtype(x):
+    """ Return x as a C-contiguous array of a dtype cv2 filters natively.
+    Integer ims cv2 has SIMD paths for are kept as is, anything else is
+    converted to float32 once here instead of being promoted by every blur and
+    arithmetic op.
+    """
+    if x.dtype in (np.uint8, np.uint16, np.int16):
+        return np.ascontiguousarray(x)
+    return np.ascontiguousarray(x, dtype=np.float32)
+
+def illum_correction(x, sigma, mode='nearest', method='subtract', kernel=None):
+    """ 
+    Gaussian blurr background subtraction.
+
+    Aim is to smooth image until it is devoid of features, but retains the
+    weighted average intensity across the image that corresponds to the
+    underlying illumination pattern. Then subtract
+
+    This correction is only aware of the single image/channel that it is fed.
+    It might be a better idea to try and implement illumination correction
+    using multiple channels/images taken from the same experiment.
+
+    kernel is blur_kernel(sigma), pass it in to avoid rebuilding it every call.
+    """
+    y = gaussian_blur(x, sigma, mode, kernel)
+    # the blurred im is scratch from here on so reuse its buffer for the result.
+    # cv2 saturates to the dtype's range in the same pass, there's no separate
+    # clip to fuse the subtract with
+    if method == 'subtract':
+        y = cv2.subtract(x, y, dst=y)
+    elif method == 'divide':
+        y = cv2.divide(x, y, dst=y)
+    else:
+        raise ValueError("Unsupported method: %s" %method)
+    return y
+
+def gaussian_blur(x, sigma, mode='nearest', kernel=None):
+    """ Gaussian blur of 2D im x, returns an im of the same shape and dtype.
+
+    For large sigma the blurred im has no detail at the scale of a few pixels,
+    so it's estimated on a copy of x shrunk by downsample_factor(sigma) and
+    interpolated back up to full size. The blur itself is done in the
+    frequency domain if the (reduced) sigma is still large.
+
+    kernel : blur_kernel(sigma), built here if not given
+    """
+    f = downsample_factor(sigma)
+    if f > 1:
+        h, w = x.shape
+        small = cv2.resize(x, (max(1, round(w/f)), max(1, round(h/f))),
+                           interpolation=cv2.INTER_AREA)
+        small = full_gaussian_blur(small, sigma/f, mode, kernel)
+        return cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+    return full_gaussian_blur(x, sigma, mode, kernel)
+
+def full_gaussian_blur(x, sigma, mode='nearest', kernel=None):
+    """ Gaussian blur of 2D im x without any downsampling, in the frequency
+    domain for large sigma. kernel is gaussian_kernel(sigma).
+    """
+    if kernel is None:
+        kernel = gaussian_kernel(sigma)
+    if sigma >= FFT_SIGMA:
+        return fft_gaussian_blur(x, sigma, mode, kernel)
+    return cv2.sepFilter2D(x, -1, kernel, kernel,
+                           borderType=BORDER_MODES[mode])
+
+def downsample_factor(sigma):
+    """ Integer factor gaussian_blur shrinks an im by before blurring with
+    sigma, 1 for no downsampling.
+    """
+    return int(max(1, min(MAX_DOWNSAMPLE, sigma // MIN_DOWNSAMPLED_SIGMA)))
+
+def blur_kernel(sigma):
+    """ The 1D kernel gaussian_blur(x, sigma) applies, i.e. for sigma at the
+    downsampled size.
+    """
+    return gaussian_kernel(sigma / downsample_factor(sigma))
+
+def gaussian_kernel(sigma):
+    """ 1D float32 gaussian kernel (column vector) truncated at 4 sigma, same
+    as scipy's gaussian_filter. Size is odd as cv2 requires.
+    """
+    ksize = int(2*round(4*sigma) + 1)
+    return cv2.getGaussianKernel(ksize, sigma).astype(np.float32)
+
+def fft_gaussian_blur(x, sigma, mode='nearest', kernel=None):
+    """ Gaussian blur of 2D image x by multiplication in the frequency domain.
+
+    x is padded by the kernel radius according to mode before the transform so
+    that the circular convolution doesn't wrap opposite edges into each other,
+    then cropped back. Returns an array of the same shape and dtype as x.
+    """
+    if kernel is None:
+        kernel = gaussian_kernel(sigma)
+    r = len(kernel) // 2
+    xp = np.pad(x.astype(np.float32), r, mode=PAD_MODES[mode])
+
+    key = (xp.shape, sigma)
+    if key not in _fft_kernels:
+        _fft_kernels[key] = gaussian_otf(xp.shape, kernel)
+
+    fft = fft_module()
+    y = fft.irfft2(fft.rfft2(xp) * _fft_kernels[key], s=xp.shape)
+    y = y[r:-r, r:-r]
+
+    if np.issubdtype(x.dtype, np.integer):
+        info = np.iinfo(x.dtype)
+        y = np.clip(np.rint(y), info.min, info.max)
+    return y.astype(x.dtype)
+
+def fft_module():
+    """ numpy style fft interface for the fft blur: multithreaded pyfftw if it
+    is installed, else np.fft. Imported and configured on first use, since the
+    fft blur is only reached at very large sigma.
+    """
+    global _fft
+    if _fft is None:
+        try:
+            import pyfftw
+        except ImportError:
+            _fft = np.fft
+        else:
+            pyfftw.config.NUM_THREADS = _fft_threads
+            pyfftw.interfaces.cache.enable()
+            _fft = pyfftw.interfaces.numpy_fft
+    return _fft
+
+def gaussian_otf(shape, kernel):
+    """ Transfer function (rfft2 layout) of the separable 2D kernel built from
+    1D kernel, centered on the origin of an array of the given shape. Built
+    from the 1D transform along each axis.
+    """
+    r = len(kernel) // 2
+    k = kernel.ravel()
+
+    fft = fft_module()
+    otf = []
+    for n, transform in zip(shape, (fft.fft, fft.rfft)):
+        # wrap the kernel around index 0
+        g = np.zeros(n)
+        g[:r+1] = k[r:]
+        g[-r:] = k[:r]
+        otf.append(transform(g))
+    return (otf[0][:, None] * otf[1][None, :]).astype(np.complex64)
+
 def outfile_names(rgb, suffix='rgb', ext='.tif'):
     """ Take dict of num : rgb im and return outfilename : rgb num
     """
@@ -436,19 +689,38 @@ def tiffread(f):
     ---
     im : numpy.ndarray
     """
+    def read_single(f):
+        # Map uncompressed image data straight from the file instead of
+        # allocating and reading it all up front. Compressed or otherwise
+        # unmappable tiffs raise ValueError, read those normally. So are
+        # big-endian tiffs (ImageJ's default), which would map to a non-native
+        # dtype cv2 can't work on
+        try:
+            im = tf.memmap(f, mode='r')
+        except ValueError:
+            return tf.imread(f)
+        if not im.dtype.isnative:
+            return tf.imread(f)
+        return im
+
     try:
         if type(f) is str:
             # single image
-            return tf.imread(f)
+            return read_single(f)
         elif type(f) is list:
             if len(f) == 1:
                 # single image
-                return tf.imread(f[0])
+                return read_single(f[0])
             elif len(f) == 3:
-                # return rgb stack
+                # return rgb stack, filled plane by plane instead of dstack'ing
+                # a list of separately allocated ims
                 f.sort(reverse=True) # so r, g, b
-                ims = [tf.imread(x) for x in f]
-                return np.dstack(ims)
+                im = tf.imread(f[0])
+                rgb = np.empty(im.shape + (3,), dtype=im.dtype)
+                rgb[..., 0] = im
+                for i in (1, 2):
+                    rgb[..., i] = tf.imread(f[i])
+                return rgb
         else:
             raise ValueError("f must be a string or list of 1 or 3 strings")
     except ValueError as e:
@@ -460,14 +732,20 @@ def tiffwrite(filename, im):
     w/ libtiff just in case:
         - need to distinguish b/t greyscale and rgb (write_rgb=True if shape 3)
 
+    Written with lossless deflate compression. Integer ims also get the
+    horizontal differencing predictor (the float one needs imagecodecs).
+    Not tiled, since ImageJ's built-in tiff reader can't open tiled files.
+
     filename : str
     im : numpy.ndarray
     """
-    tf.imwrite(filename, im)
+    tf.imwrite(filename, im, compression='zlib',
+               predictor=np.issubdtype(im.dtype, np.integer))
 
-def cleanup():
-    # remove any generated dummy tifs
-    dummy_files = glob('*.dummy')
+def cleanup(path='.'):
+    # remove any generated dummy tifs in dir path
+    dummy_files = [os.path.join(path, f) for f in os.listdir(path)
+                   if f.endswith('.dummy')]
     for f in dummy_files:
         try:
             os.remove(f)